@@ -1,51 +1,100 @@
 """
 Book info summarization module.
 
-Fetches compact summaries and AI context for books using Claude CLI.
+Fetches compact summaries and AI context for books using the Anthropic API
+(when ANTHROPIC_API_KEY is set) or the Claude CLI.
 Caches results for future requests.
 """
 
 import asyncio
 import hashlib
 import json
-import re
+import os
+import sqlite3
 import subprocess
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from typing import Optional
 
-# Precompile regex patterns for performance
-_PARAGRAPH_PATTERN = re.compile(r'<p[^>]*>(.*?)</p>', re.DOTALL)
-_HTML_TAG_PATTERN = re.compile(r'<[^>]+>')
+import anthropic
+from selectolax.lexbor import LexborHTMLParser
 
 # Cache directory for book summaries
 CACHE_DIR = Path.home() / ".reader3_cache"
 CACHE_DIR.mkdir(exist_ok=True)
 
-
-def _get_cache_path(book_id: str) -> Path:
-    """Get the cache file path for a book summary."""
-    return CACHE_DIR / f"{book_id}_summary.json"
+# All cached responses live in one SQLite key/value table. The connection is
+# shared by the worker threads running the Claude helpers, hence the lock.
+# Under WAL, synchronous=NORMAL skips the fsync on every commit; a crash can
+# at worst lose the last few cached responses, which are simply fetched again.
+_db = sqlite3.connect(CACHE_DIR / "cache.db", check_same_thread=False)
+_db.execute("PRAGMA journal_mode=WAL")
+_db.execute("PRAGMA synchronous=NORMAL")
+_db.execute("CREATE TABLE IF NOT EXISTS kv (k TEXT PRIMARY KEY, v TEXT)")
+_db_lock = threading.Lock()
+
+# Recently read or written entries, so warm page loads skip SQLite entirely.
+# Guarded by _db_lock as well.
+MEMO_CACHE_SIZE = 4096
+_memo: "OrderedDict[str, str]" = OrderedDict()
+
+# Direct API access: one client for the whole process so HTTP connections are
+# reused across prompts. Without an API key we fall back to the Claude CLI.
+API_MODEL = os.getenv("ANTHROPIC_MODEL", "claude-haiku-4-5")
+API_MAX_TOKENS = 512
+API_ENABLED = bool(os.getenv("ANTHROPIC_API_KEY"))
+_client = (
+    anthropic.Anthropic(api_key=os.getenv("ANTHROPIC_API_KEY"), timeout=30)
+    if API_ENABLED
+    else None
+)
+
+
+# Without an API key, prompts go to the Claude CLI, one process per prompt.
+# The prompt is written to stdin rather than passed as an argument, so long
+# chapter excerpts can't hit the command-line length limit.
+CLI_TIMEOUT = 30
+_CLI_COMMAND = ["claude", "-p", "--output-format", "json", "--no-session-persistence"]
+
+
+def _content_hash(text: str) -> str:
+    """Short cache-key hash of a text excerpt (BLAKE2b from the stdlib, 8 hex chars)."""
+    return hashlib.blake2b(text.encode(), digest_size=4).hexdigest()
+
+
+def _remember(key: str, value: str) -> None:
+    """Put an entry in the in-memory layer, evicting the oldest. Caller holds _db_lock."""
+    _memo[key] = value
+    _memo.move_to_end(key)
+    if len(_memo) > MEMO_CACHE_SIZE:
+        _memo.popitem(last=False)
 
 
 def _load_cached_summary(book_id: str) -> Optional[str]:
     """Load cached summary if it exists."""
-    cache_path = _get_cache_path(book_id)
-    if cache_path.exists():
-        try:
-            with open(cache_path) as f:
-                data = json.load(f)
-                return data.get("summary")
-        except Exception:
-            pass
-    return None
+    try:
+        with _db_lock:
+            summary = _memo.get(book_id)
+            if summary is not None:
+                _memo.move_to_end(book_id)
+                return summary
+            row = _db.execute("SELECT v FROM kv WHERE k = ?", (book_id,)).fetchone()
+            if row:
+                _remember(book_id, row[0])
+        return row[0] if row else None
+    except Exception:
+        return None
 
 
 def _save_summary(book_id: str, summary: str) -> None:
     """Save summary to cache."""
-    cache_path = _get_cache_path(book_id)
     try:
-        with open(cache_path, "w") as f:
-            json.dump({"summary": summary}, f)
+        with _db_lock:
+            _db.execute("INSERT OR REPLACE INTO kv VALUES (?, ?)", (book_id, summary))
+            _db.commit()
+            _remember(book_id, summary)
     except Exception:
         pass
 
@@ -73,8 +122,8 @@ def _is_valid_response(response: str) -> bool:
     return not any(pattern in lower for pattern in explanatory_patterns)
 
 
-def _fetch_from_claude(prompt: str) -> Optional[str]:
-    """Fetch a response from Claude Code CLI.
+def _fetch_from_api(prompt: str) -> Optional[str]:
+    """Fetch a response through the shared Anthropic API client.
 
     Args:
         prompt: The prompt to send to Claude
@@ -83,47 +132,53 @@ def _fetch_from_claude(prompt: str) -> Optional[str]:
         The response text, or None if the request failed
     """
     try:
-        result = subprocess.run(
-            ["claude", "-p", prompt],
-            capture_output=True,
-            text=True,
-            timeout=30
+        message = _client.messages.create(
+            model=API_MODEL,
+            max_tokens=API_MAX_TOKENS,
+            messages=[{"role": "user", "content": prompt}]
         )
+        text = "".join(block.text for block in message.content if block.type == "text")
+        return text.strip() or None
 
-        if result.returncode == 0:
-            return result.stdout.strip()
-
-        error_msg = result.stderr.lower() if result.stderr else ""
-        if "auth" in error_msg or "unauthorized" in error_msg or "signed in" in error_msg:
-            return "Sign in to Claude Code CLI to enable this feature"
-        return None
-
-    except subprocess.TimeoutExpired:
-        return "Request timeout - try again later"
-    except FileNotFoundError:
-        return "Claude Code CLI not found"
     except Exception:
+        # Timeouts, bad keys, etc.: no text, so callers neither show nor cache it
         return None
 
 
-def _extract_text_content(html: str, min_length: int = 100) -> str:
-    """Extract and clean text content from HTML, stripping tags and excess whitespace.
-
-    Keeps consuming content until reaching min_length of clean text, skipping images/markup.
+def _fetch_from_claude(prompt: str) -> Optional[str]:
+    """Fetch a response from Claude, via the API client if configured, else the Claude Code CLI.
 
     Args:
-        html: HTML content to clean
-        min_length: Minimum characters required for valid content
+        prompt: The prompt to send to Claude
 
     Returns:
-        Cleaned text up to min_length (or more if necessary), or empty string if insufficient
+        The response text, or None if the request failed
     """
-    # Remove HTML tags
-    text = re.sub(r'<[^>]+>', '', html)
-    # Remove extra whitespace
-    text = re.sub(r'\s+', ' ', text).strip()
-    # Return text if we have enough real content
-    return text if len(text) >= min_length else ""
+    if _client is not None:
+        return _fetch_from_api(prompt)
+
+    try:
+        proc = subprocess.run(
+            _CLI_COMMAND,
+            input=prompt,
+            capture_output=True,
+            text=True,
+            timeout=CLI_TIMEOUT
+        )
+
+        try:
+            result = json.loads(proc.stdout)
+        except ValueError:
+            result = {}
+
+        if proc.returncode != 0 or result.get("is_error"):
+            # Signed out, rate limited, etc.: same as the API path, nothing to show or cache
+            return None
+        return (result.get("result") or "").strip() or None
+
+    except Exception:
+        # Timeouts, CLI not installed, etc.
+        return None
 
 
 def get_book_summary_cached(book_id: str, title: str, author: str, first_chapter_clean: str) -> str:
@@ -165,7 +220,7 @@ def get_chapter_prephrase(book_id: str, title: str, author: str, chapter_clean:
     if not chapter_clean:
         return ""
 
-    chapter_hash = hashlib.md5(chapter_clean[:500].encode()).hexdigest()[:8]
+    chapter_hash = _content_hash(chapter_clean[:500])
     prephrase_cache_key = f"{book_id}_prephrase_{chapter_hash}"
 
     cached = _load_cached_summary(prephrase_cache_key)
@@ -201,7 +256,7 @@ def get_ai_conclusion(book_id: str, clean_text: str, title: str, author: str, bo
 
     Args:
         book_id: Unique identifier for the book (for caching)
-        clean_text: Already cleaned plain text (1000+ chars, no HTML/images)
+        clean_text: Whole chapter as plain text (1000+ chars, no HTML/images)
         title: Book title
         author: Book author
         book_summary: Optional summary of the book for context
@@ -213,7 +268,7 @@ def get_ai_conclusion(book_id: str, clean_text: str, title: str, author: str, bo
         return ""
 
     # Use chapter hash as part of cache key to avoid conflicts
-    content_hash = hashlib.md5(clean_text[:500].encode()).hexdigest()[:8]
+    content_hash = _content_hash(clean_text[:500])
     cache_key = f"{book_id}_conclusion_{content_hash}"
     cached = _load_cached_summary(cache_key)
     if cached:
@@ -247,7 +302,7 @@ Otherwise provide only the conclusion, no other text."""
 
 
 def _split_into_paragraph_groups(content: str, min_length: int = 500, max_groups: int = 10) -> list[str]:
-    """Split HTML into groups with guaranteed minimum length, capped at max_groups.
+    """Split HTML into plain-text groups with guaranteed minimum length, capped at max_groups.
 
     Args:
         content: HTML chapter content
@@ -255,24 +310,24 @@ def _split_into_paragraph_groups(content: str, min_length: int = 500, max_groups
         max_groups: Maximum number of groups to create (cap LLM requests)
 
     Returns:
-        List of group HTML strings
+        List of group texts
     """
-    p_matches = list(_PARAGRAPH_PATTERN.finditer(content))
-    if not p_matches:
-        return [content.strip()] if content.strip() else []
+    # One C-level parse gives both the paragraphs and their text
+    tree = LexborHTMLParser(content)
+    p_nodes = tree.css('p')
+    if not p_nodes:
+        node = tree.body or tree.root
+        text = node.text().strip() if node else ""
+        return [text] if text else []
 
     # Extract and filter non-empty paragraphs
-    paragraphs = []
-    for match in p_matches:
-        clean = _HTML_TAG_PATTERN.sub('', match.group(1)).strip()
-        if clean:
-            paragraphs.append(match.group(0))
+    paragraphs = [text for text in (p.text() for p in p_nodes) if text.strip()]
 
     if not paragraphs:
         return []
 
     # Calculate total content and target group length
-    total_length = sum(len(_HTML_TAG_PATTERN.sub('', p)) for p in paragraphs)
+    total_length = sum(len(p) for p in paragraphs)
     target_length = max(min_length, total_length // max_groups)
 
     # Group paragraphs to meet target length
@@ -280,10 +335,9 @@ def _split_into_paragraph_groups(content: str, min_length: int = 500, max_groups
     current_group = []
     current_length = 0
 
-    for para_html in paragraphs:
-        para_length = len(_HTML_TAG_PATTERN.sub('', para_html))
-        current_group.append(para_html)
-        current_length += para_length
+    for para_text in paragraphs:
+        current_group.append(para_text)
+        current_length += len(para_text)
 
         # Flush when we hit target length and haven't hit max groups yet
         if (current_length >= target_length and len(groups) < max_groups - 1) or current_length >= target_length * 1.5:
@@ -302,18 +356,17 @@ def _get_paragraph_group_summary(group_text: str, book_title: str = "", book_aut
     """Get an intriguing 2-6 word teaser for a paragraph group (shown before reading).
 
     Args:
-        group_text: HTML text to summarize
+        group_text: Plain text of the group to summarize
         book_title: Book title for context
         book_author: Book author for context
     """
-    # Clean HTML and strip
-    clean_text = _HTML_TAG_PATTERN.sub('', group_text).strip()
+    clean_text = group_text.strip()
 
     if not clean_text or len(clean_text) < 1000:
         return None
 
     # Generate cache key from content hash
-    content_hash = hashlib.md5(clean_text[:200].encode()).hexdigest()[:8]
+    content_hash = _content_hash(clean_text[:200])
     cache_key = f"para_summary_{content_hash}"
 
     # Check cache
@@ -349,6 +402,21 @@ Otherwise provide ONLY the 2-6 words, nothing else."""
     return result
 
 
+# Paragraph teasers fan out up to 10 prompts per chapter view. A small
+# dedicated pool caps how many run at once across all requests, instead of
+# letting them crowd the default executor the other helpers share.
+PARAGRAPH_SUMMARY_WORKERS = 3
+_paragraph_executor = ThreadPoolExecutor(
+    max_workers=PARAGRAPH_SUMMARY_WORKERS,
+    thread_name_prefix="paragraph-summary"
+)
+
+# Teaser prompts in flight, keyed by (group text, title, author). Identical
+# groups within a chapter or from concurrent views of the same chapter share
+# one call. Only touched from the event loop, so it needs no lock.
+_inflight_teasers: dict[tuple[str, str, str], asyncio.Future] = {}
+
+
 async def get_paragraph_summaries(
     content: str,
     book_title: str = "",
@@ -370,16 +438,27 @@ async def get_paragraph_summaries(
         return {}
 
     # Create tasks with book context
+    loop = asyncio.get_running_loop()
+
     async def get_summary(i: int, group_text: str) -> tuple[int, Optional[str]]:
-        result = await asyncio.to_thread(
-            _get_paragraph_group_summary,
-            group_text,
-            book_title,
-            book_author
-        )
+        # Join an identical prompt that is already running instead of repeating it
+        key = (group_text, book_title, book_author)
+        future = _inflight_teasers.get(key)
+        if future is None:
+            future = loop.run_in_executor(
+                _paragraph_executor,
+                _get_paragraph_group_summary,
+                group_text,
+                book_title,
+                book_author
+            )
+            _inflight_teasers[key] = future
+            future.add_done_callback(lambda _: _inflight_teasers.pop(key, None))
+        # Shielded so one cancelled request doesn't cancel the call for the others
+        result = await asyncio.shield(future)
         return (i, result)
 
-    # Run all summaries in true parallel using gather
+    # Run all summaries in parallel, at most PARAGRAPH_SUMMARY_WORKERS at a time
     results = await asyncio.gather(*[
         get_summary(i, group_text)
         for i, group_text in enumerate(groups)
@@ -2,17 +2,35 @@
 Parses an EPUB file into a structured object that can be used to serve the book via a web interface.
 """
 
+import mmap
 import os
-import pickle
+import re
 import shutil
-from dataclasses import dataclass, field
-from typing import List, Dict, Optional, Any
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import asdict, dataclass, field, replace
+from functools import cached_property, lru_cache, partial
+from typing import List, Dict, Optional, Any, Tuple
 from datetime import datetime
-from urllib.parse import unquote
+from urllib.parse import quote, unquote
 
 import ebooklib
+import msgpack
 from ebooklib import epub
-from bs4 import BeautifulSoup, Comment
+from selectolax.lexbor import LexborHTMLParser
+
+# Processed book file inside each <name>_data folder
+BOOK_FILENAME = 'book.msgpack'
+# Every chapter body (msgpack of content + sample) back to back; the index
+# records each one's (offset, length) in Book.chapter_spans
+CHAPTERS_FILENAME = 'chapters.bin'
+# How many chapter bodies each loaded book keeps in memory
+CHAPTER_CACHE_SIZE = 8
+# Chapters with less plain text than this get no AI sample (front matter, etc.)
+AI_SAMPLE_MIN_LENGTH = 1000
+# Opening text stored for the book summary and chapter prephrase prompts
+# (the conclusion reads the whole chapter via ChapterContent.text)
+AI_SAMPLE_LENGTH = 1000
 
 # --- Data structures ---
 
@@ -26,8 +44,13 @@ class ChapterContent:
     href: str         # Filename (e.g., 'part01.html')
     title: str        # Best guess title from file
     content: str      # Cleaned HTML with rewritten image paths
-    text: str         # Plain text for search/LLM context
     order: int        # Linear reading order
+    sample: str = ""  # Start of the plain text for the AI prompts, empty if too short
+
+    @cached_property
+    def text(self) -> str:
+        """Plain text for search/LLM context, derived from content on first use."""
+        return extract_plain_text(parse_html(self.content))
 
 
 @dataclass
@@ -39,6 +62,11 @@ class TOCEntry:
     anchor: str       # just the anchor (e.g., 'chapter1'), empty if none
     children: List['TOCEntry'] = field(default_factory=list)
 
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> 'TOCEntry':
+        children = [cls.from_dict(child) for child in data.get('children', [])]
+        return cls(**{**data, 'children': children})
+
 
 @dataclass
 class BookMetadata:
@@ -55,7 +83,11 @@ class BookMetadata:
 
 @dataclass
 class Book:
-    """The Master Object to be pickled."""
+    """
+    The Master Object to be serialized.
+    A book returned by load_book() only holds the spine index (content and
+    sample left empty); use get_chapter() to read a chapter's body.
+    """
     metadata: BookMetadata
     spine: List[ChapterContent]  # The actual content (linear files)
     toc: List[TOCEntry]          # The navigation tree
@@ -66,68 +98,126 @@ class Book:
     processed_at: str
     version: str = "3.0"
 
+    # AI sample of the first chapter, kept in the index for the book summary
+    intro_sample: str = ""
+
+    # (offset, length) of each spine item's body in the chapters file
+    chapter_spans: List[List[int]] = field(default_factory=list, repr=False, compare=False)
+
+    # Where chapter bodies live on disk; None while everything is in memory
+    chapters_path: Optional[str] = field(default=None, repr=False, compare=False)
+
+    # (mtime_ns, size) of the index this book was loaded from, to spot a re-processed book
+    index_stamp: Optional[Tuple[int, int]] = field(default=None, repr=False, compare=False)
+
+    def __post_init__(self):
+        self._chapters_map: Optional[mmap.mmap] = None
+        self._cached_chapter = lru_cache(maxsize=CHAPTER_CACHE_SIZE)(self._read_chapter)
+
+    def get_chapter(self, index: int) -> ChapterContent:
+        """Full chapter at spine position `index`, read from disk on demand."""
+        if self.chapters_path is None:
+            return self.spine[index]
+        return self._cached_chapter(index)
+
+    def _read_chapter(self, index: int) -> ChapterContent:
+        # Mapped once per book; only the pages of chapters actually read get loaded
+        if self._chapters_map is None:
+            with open(self.chapters_path, 'rb') as f:
+                self._chapters_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        offset, length = self.chapter_spans[index]
+        body = msgpack.unpackb(self._chapters_map[offset:offset + length], raw=False)
+        return replace(self.spine[index], **body)
+
+    def to_dict(self) -> Dict[str, Any]:
+        """Plain dicts/lists/strings only, ready for msgpack."""
+        data = asdict(self)
+        del data['chapters_path']
+        del data['index_stamp']
+        return data
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> 'Book':
+        return cls(
+            metadata=BookMetadata(**data['metadata']),
+            spine=[ChapterContent(**{'content': "", **chapter}) for chapter in data['spine']],
+            toc=[TOCEntry.from_dict(entry) for entry in data['toc']],
+            images=data['images'],
+            source_file=data['source_file'],
+            processed_at=data['processed_at'],
+            version=data.get('version', "3.0"),
+            intro_sample=data.get('intro_sample', ""),
+            chapter_spans=data.get('chapter_spans', []),
+        )
+
 
 # --- Utilities ---
 
-def clean_html_content(soup: BeautifulSoup) -> BeautifulSoup:
+# XHTML allows `<a id="x"/>` on any element, but an HTML5 parser treats it as an
+# open tag and swallows the following content. Expand non-void ones up front.
+# Attributes are matched quote-aware so a `/>` inside a value is left alone.
+_SELF_CLOSING_PATTERN = re.compile(
+    r'<(?!(?:area|base|br|col|embed|hr|img|input|link|meta|param|source|track|wbr)\b)'
+    r'([a-z][\w:.-]*)(\s(?:[^<>"\']|"[^"]*"|\'[^\']*\')*?)?\s*/>',
+    re.IGNORECASE
+)
+
+
+def parse_html(raw_content: str) -> LexborHTMLParser:
+    """Parse (X)HTML with the C-backed lexbor parser."""
+    return LexborHTMLParser(_SELF_CLOSING_PATTERN.sub(r'<\1\2></\1>', raw_content))
+
+
+def clean_html_content(tree: LexborHTMLParser) -> LexborHTMLParser:
 
     # Remove dangerous/useless tags
-    for tag in soup(['script', 'style', 'iframe', 'video', 'nav', 'form', 'button']):
-        tag.decompose()
+    tree.strip_tags(['script', 'style', 'iframe', 'video', 'nav', 'form', 'button', 'input'])
 
     # Remove HTML comments
-    for comment in soup.find_all(string=lambda text: isinstance(text, Comment)):
-        comment.extract()
-
-    # Remove input tags
-    for tag in soup.find_all('input'):
-        tag.decompose()
+    comments = [node for node in tree.root.traverse(include_text=True) if node.is_comment_node]
+    for comment in comments:
+        comment.decompose()
 
-    return soup
+    return tree
 
 
-def extract_plain_text(soup: BeautifulSoup) -> str:
+def extract_plain_text(tree: LexborHTMLParser) -> str:
     """Extract clean text for LLM/Search usage."""
-    text = soup.get_text(separator=' ')
+    node = tree.body or tree.root
+    text = node.text(separator=' ')
     # Collapse whitespace
     return ' '.join(text.split())
 
 
-def parse_toc_recursive(toc_list, depth=0) -> List[TOCEntry]:
+def _toc_entry(node) -> TOCEntry:
+    """Builds a TOCEntry (without children) from an ebooklib Link or Section."""
+    file_href, _, anchor = node.href.partition('#')
+    return TOCEntry(title=node.title, href=node.href, file_href=file_href, anchor=anchor)
+
+
+def parse_toc(toc_list) -> List[TOCEntry]:
     """
-    Recursively parses the TOC structure from ebooklib.
+    Parses the TOC structure from ebooklib.
+    Walks the tree with an explicit stack, so deeply nested TOCs can't hit
+    the recursion limit.
     """
     result = []
-
-    for item in toc_list:
-        # ebooklib TOC items are either `Link` objects or tuples (Section, [Children])
-        if isinstance(item, tuple):
-            section, children = item
-            entry = TOCEntry(
-                title=section.title,
-                href=section.href,
-                file_href=section.href.split('#')[0],
-                anchor=section.href.split('#')[1] if '#' in section.href else "",
-                children=parse_toc_recursive(children, depth + 1)
-            )
-            result.append(entry)
-        elif isinstance(item, epub.Link):
-            entry = TOCEntry(
-                title=item.title,
-                href=item.href,
-                file_href=item.href.split('#')[0],
-                anchor=item.href.split('#')[1] if '#' in item.href else ""
-            )
-            result.append(entry)
-        # Note: ebooklib sometimes returns direct Section objects without children
-        elif isinstance(item, epub.Section):
-             entry = TOCEntry(
-                title=item.title,
-                href=item.href,
-                file_href=item.href.split('#')[0],
-                anchor=item.href.split('#')[1] if '#' in item.href else ""
-            )
-             result.append(entry)
+    stack = deque([(toc_list, result)])
+
+    while stack:
+        items, siblings = stack.pop()
+        for item in items:
+            # ebooklib TOC items are either `Link` objects or tuples (Section, [Children])
+            if isinstance(item, tuple):
+                section, children = item
+                entry = _toc_entry(section)
+                stack.append((children, entry.children))
+            # Note: ebooklib sometimes returns direct Section objects without children
+            elif isinstance(item, (epub.Link, epub.Section)):
+                entry = _toc_entry(item)
+            else:
+                continue
+            siblings.append(entry)
 
     return result
 
@@ -172,6 +262,57 @@ def extract_metadata_robust(book_obj) -> BookMetadata:
 
 # --- Main Conversion Logic ---
 
+# Below this many chapters, spinning up worker processes costs more than it saves
+PARALLEL_MIN_CHAPTERS = 32
+
+# Anything other than letters, digits, '.', '_' and '-' is dropped from image filenames
+_UNSAFE_FNAME_PATTERN = re.compile(r'[^\w.-]+')
+
+
+def _process_chapter(raw_content: bytes, image_lookup: Dict[str, str]) -> Tuple[str, str]:
+    """
+    Turns one spine document into (body HTML, AI sample text).
+    Top-level and free of ebooklib objects so it can run in a worker process.
+    """
+    tree = parse_html(raw_content.decode('utf-8', errors='ignore'))
+
+    # A. Fix Images
+    for img in tree.tags('img'):
+        src = img.attributes.get('src', '')
+        if not src: continue
+
+        # Try the full src first, then just the filename (e.g. '../images/x.jpg')
+        new_src = image_lookup.get(src) or image_lookup.get(src.rpartition('/')[2])
+        if not new_src:
+            # Percent-encoded differently than the pre-indexed quote() spelling
+            src_decoded = unquote(src)
+            new_src = image_lookup.get(src_decoded) or image_lookup.get(src_decoded.rpartition('/')[2])
+        if new_src:
+            img.attrs['src'] = new_src
+
+    # B. Clean HTML
+    tree = clean_html_content(tree)
+
+    # C. Extract Body Content only
+    body = tree.body
+    if body:
+        # Extract inner HTML of body
+        final_html = body.inner_html or ""
+    else:
+        final_html = tree.html or ""
+
+    # D. Plain text for the AI prompts, computed once here instead of per request.
+    # Text is never longer than the markup it came from, so short documents
+    # (covers, title pages, colophons) can't reach the minimum and are skipped.
+    sample = ""
+    if len(raw_content) >= AI_SAMPLE_MIN_LENGTH:
+        text = extract_plain_text(tree)
+        if len(text) >= AI_SAMPLE_MIN_LENGTH:
+            sample = text[:AI_SAMPLE_LENGTH]
+
+    return final_html, sample
+
+
 def process_epub(epub_path: str, output_dir: str) -> Book:
 
     # 1. Load Book
@@ -196,12 +337,15 @@ def process_epub(epub_path: str, output_dir: str) -> Book:
             # Normalize filename
             original_fname = os.path.basename(item.get_name())
             # Sanitize filename for OS
-            safe_fname = "".join([c for c in original_fname if c.isalpha() or c.isdigit() or c in '._-']).strip()
+            safe_fname = _UNSAFE_FNAME_PATTERN.sub('', original_fname)
 
             # Save to disk
             local_path = os.path.join(images_dir, safe_fname)
             with open(local_path, 'wb') as f:
                 f.write(item.get_content())
+            # ebooklib holds every item's bytes from read_epub on; this was the
+            # only use of the image data, so release it before chapter processing
+            item.set_content(b"")
 
             # Map keys: We try both the full internal path and just the basename
             # to be robust against messy HTML src attributes
@@ -209,18 +353,28 @@ def process_epub(epub_path: str, output_dir: str) -> Book:
             image_map[item.get_name()] = rel_path
             image_map[original_fname] = rel_path
 
+    # Pre-index every spelling an <img src> might use (quoted/unquoted,
+    # full path/basename) so the spine loop is a plain dict probe per image
+    image_lookup = {}
+    for key, rel_path in image_map.items():
+        for variant in (key, unquote(key), quote(key)):
+            image_lookup[variant] = rel_path
+    for key, rel_path in list(image_lookup.items()):
+        image_lookup.setdefault(os.path.basename(key), rel_path)
+
     # 5. Process TOC
     print("Parsing Table of Contents...")
-    toc_structure = parse_toc_recursive(book.toc)
+    toc_structure = parse_toc(book.toc)
     if not toc_structure:
         print("Warning: Empty TOC, building fallback from Spine...")
         toc_structure = get_fallback_toc(book)
 
     # 6. Process Content (Spine-based to preserve HTML validity)
     print("Processing chapters...")
-    spine_chapters = []
 
-    # We iterate over the spine (linear reading order)
+    # We iterate over the spine (linear reading order), reading raw bytes up
+    # front since ebooklib items can't be sent to worker processes
+    jobs = []
     for i, spine_item in enumerate(book.spine):
         item_id, linear = spine_item
         item = book.get_item_with_id(item_id)
@@ -229,46 +383,29 @@ def process_epub(epub_path: str, output_dir: str) -> Book:
             continue
 
         if item.get_type() == ebooklib.ITEM_DOCUMENT:
-            # Raw content
-            raw_content = item.get_content().decode('utf-8', errors='ignore')
-            soup = BeautifulSoup(raw_content, 'html.parser')
-
-            # A. Fix Images
-            for img in soup.find_all('img'):
-                src = img.get('src', '')
-                if not src: continue
-
-                # Decode URL (part01/image%201.jpg -> part01/image 1.jpg)
-                src_decoded = unquote(src)
-                filename = os.path.basename(src_decoded)
-
-                # Try to find in map
-                if src_decoded in image_map:
-                    img['src'] = image_map[src_decoded]
-                elif filename in image_map:
-                    img['src'] = image_map[filename]
-
-            # B. Clean HTML
-            soup = clean_html_content(soup)
-
-            # C. Extract Body Content only
-            body = soup.find('body')
-            if body:
-                # Extract inner HTML of body
-                final_html = "".join([str(x) for x in body.contents])
-            else:
-                final_html = str(soup)
-
-            # D. Create Object
-            chapter = ChapterContent(
-                id=item_id,
-                href=item.get_name(), # Important: This links TOC to Content
-                title=f"Section {i+1}", # Fallback, real titles come from TOC
-                content=final_html,
-                text=extract_plain_text(soup),
-                order=i
-            )
-            spine_chapters.append(chapter)
+            jobs.append((i, item_id, item.get_name(), item.get_content()))
+
+    render = partial(_process_chapter, image_lookup=image_lookup)
+    raw_contents = [raw for _, _, _, raw in jobs]
+    workers = os.cpu_count() or 1
+    if len(jobs) >= PARALLEL_MIN_CHAPTERS and workers > 1:
+        chunksize = max(1, len(jobs) // (4 * workers))
+        with ProcessPoolExecutor() as executor:
+            rendered = list(executor.map(render, raw_contents, chunksize=chunksize))
+    else:
+        rendered = list(map(render, raw_contents))
+
+    spine_chapters = [
+        ChapterContent(
+            id=item_id,
+            href=item_name, # Important: This links TOC to Content
+            title=f"Section {i+1}", # Fallback, real titles come from TOC
+            content=final_html,
+            order=i,
+            sample=sample
+        )
+        for (i, item_id, item_name, _), (final_html, sample) in zip(jobs, rendered)
+    ]
 
     # 7. Final Assembly
     final_book = Book(
@@ -277,17 +414,49 @@ def process_epub(epub_path: str, output_dir: str) -> Book:
         toc=toc_structure,
         images=image_map,
         source_file=os.path.basename(epub_path),
-        processed_at=datetime.now().isoformat()
+        processed_at=datetime.now().isoformat(),
+        intro_sample=spine_chapters[0].sample if spine_chapters else ""
     )
 
     return final_book
 
 
-def save_to_pickle(book: Book, output_dir: str):
-    p_path = os.path.join(output_dir, 'book.pkl')
-    with open(p_path, 'wb') as f:
-        pickle.dump(book, f)
-    print(f"Saved structured data to {p_path}")
+def save_book(book: Book, output_dir: str):
+    data = book.to_dict()
+
+    # Chapter bodies go into one separate file so the server can read them one
+    # at a time; the index only keeps where each one starts and how long it is.
+    # Both files are written aside and swapped in, so a server that still has
+    # the old ones mapped keeps reading consistent (old) data until it reloads
+    spans = []
+    c_path = os.path.join(output_dir, CHAPTERS_FILENAME)
+    with open(c_path + '.tmp', 'wb') as f:
+        for chapter in data['spine']:
+            body = msgpack.packb(
+                {'content': chapter.pop('content'), 'sample': chapter.pop('sample')},
+                use_bin_type=True
+            )
+            spans.append([f.tell(), len(body)])
+            f.write(body)
+    os.replace(c_path + '.tmp', c_path)
+    data['chapter_spans'] = spans
+
+    b_path = os.path.join(output_dir, BOOK_FILENAME)
+    with open(b_path + '.tmp', 'wb') as f:
+        msgpack.pack(data, f, use_bin_type=True)
+    os.replace(b_path + '.tmp', b_path)
+    print(f"Saved structured data to {b_path}")
+
+
+def load_book(book_dir: str) -> Book:
+    b_path = os.path.join(book_dir, BOOK_FILENAME)
+    # Decode straight from the mapped pages instead of reading into a bytes copy first
+    with open(b_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        book = Book.from_dict(msgpack.unpackb(mm, raw=False))
+        st = os.fstat(f.fileno())
+    book.chapters_path = os.path.join(book_dir, CHAPTERS_FILENAME)
+    book.index_stamp = (st.st_mtime_ns, st.st_size)
+    return book
 
 
 # --- CLI ---
@@ -304,7 +473,7 @@ if __name__ == "__main__":
     out_dir = os.path.splitext(epub_file)[0] + "_data"
 
     book_obj = process_epub(epub_file, out_dir)
-    save_to_pickle(book_obj, out_dir)
+    save_book(book_obj, out_dir)
     print("\n--- Summary ---")
     print(f"Title: {book_obj.metadata.title}")
     print(f"Authors: {', '.join(book_obj.metadata.authors)}")
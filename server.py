@@ -1,57 +1,115 @@
+import asyncio
 import os
-import pickle
-from functools import lru_cache
-from typing import Optional
+from collections import OrderedDict
+from typing import Optional, Tuple
 
 from fastapi import FastAPI, Request, HTTPException
 from fastapi.responses import HTMLResponse, FileResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
+from jinja2 import Environment, FileSystemBytecodeCache, FileSystemLoader
 
-from reader3 import Book, BookMetadata, ChapterContent, TOCEntry
+from reader3 import BOOK_FILENAME, Book, BookMetadata, ChapterContent, TOCEntry, load_book
 from claude_code_detect import get_claude_code_status
 from book_info import (
-    get_book_summary,
-    get_ai_prephrase,
+    API_ENABLED,
+    CACHE_DIR,
     get_ai_conclusion,
+    get_book_summary_cached,
+    get_chapter_prephrase,
     get_paragraph_summaries,
 )
 
 app = FastAPI()
-templates = Jinja2Templates(directory="templates")
+# Templates are compiled once per process (no file check on every render),
+# and the compiled code is kept on disk so restarts skip the parse as well
+TEMPLATE_CACHE_DIR = CACHE_DIR / "jinja"
+TEMPLATE_CACHE_DIR.mkdir(exist_ok=True)
+templates = Jinja2Templates(env=Environment(
+    loader=FileSystemLoader("templates"),
+    autoescape=True,
+    auto_reload=False,
+    bytecode_cache=FileSystemBytecodeCache(str(TEMPLATE_CACHE_DIR))
+))
 
 # Where are the book folders located?
 BOOKS_DIR = "."
 
+# Extensions served by the loose-image catch-all route
+_IMAGE_EXTENSIONS = frozenset({'.jpg', '.jpeg', '.png', '.gif', '.webp', '.svg'})
+
 # Get Claude Code status once at startup
 CLAUDE_CODE_STATUS = get_claude_code_status()
 
-@lru_cache(maxsize=1)
-def load_book_cached(folder_name: str) -> Optional[Book]:
-    """
-    Loads the book from the pickle file.
-    Cached so we don't re-read the disk on every click.
-    """
-    file_path = os.path.join(BOOKS_DIR, folder_name, "book.pkl")
-    if not os.path.exists(file_path):
+# Whether any Claude backend can answer. Without one, chapter pages skip the
+# AI helpers instead of having each of them fail on its own
+AI_ENABLED = API_ENABLED or CLAUDE_CODE_STATUS["enabled"]
+
+# Deserialized books, keyed by folder name, least recently read first.
+# Bounded so a long-running server with many books doesn't keep them all.
+BOOKS_CACHE_SIZE = int(os.getenv("BOOKS_CACHE_SIZE", "16"))
+_BOOK_CACHE: "OrderedDict[str, Book]" = OrderedDict()
+
+def _load_book_sync(folder_name: str) -> Optional[Book]:
+    """Loads the book from the msgpack file."""
+    book_dir = os.path.join(BOOKS_DIR, folder_name)
+    if not os.path.exists(os.path.join(book_dir, BOOK_FILENAME)):
         return None
 
     try:
-        with open(file_path, "rb") as f:
-            book = pickle.load(f)
-        return book
+        return load_book(book_dir)
     except Exception as e:
         print(f"Error loading book {folder_name}: {e}")
         return None
 
+def _index_stamp(folder_name: str) -> Optional[Tuple[int, int]]:
+    """(mtime_ns, size) of the book's index file, None if it's gone."""
+    try:
+        st = os.stat(os.path.join(BOOKS_DIR, folder_name, BOOK_FILENAME))
+    except OSError:
+        return None
+    return st.st_mtime_ns, st.st_size
+
+async def load_book_cached(folder_name: str) -> Optional[Book]:
+    """
+    Returns the book, decoding it in a worker thread on first access so a
+    cold load doesn't block the event loop.
+    Cached (LRU, BOOKS_CACHE_SIZE books) so we don't re-read the disk on every click;
+    a cached book is reloaded when its index file changes (the book was re-processed).
+    """
+    book = _BOOK_CACHE.get(folder_name)
+    if book is not None and _index_stamp(folder_name) == book.index_stamp:
+        _BOOK_CACHE.move_to_end(folder_name)
+        return book
+
+    _BOOK_CACHE.pop(folder_name, None)
+    book = await asyncio.to_thread(_load_book_sync, folder_name)
+    if book is not None:
+        _BOOK_CACHE[folder_name] = book
+        if len(_BOOK_CACHE) > BOOKS_CACHE_SIZE:
+            _BOOK_CACHE.popitem(last=False)
+    return book
+
+# The book served at `/` and by the image fallback. book.py sets it to the
+# book it just processed; otherwise _get_book_folder() finds it on first use.
+CURRENT_BOOK_FOLDER: Optional[str] = None
+
 def _get_book_folder() -> Optional[str]:
-    """Get the single book folder. Returns None if not found or multiple exist."""
-    if os.path.exists(BOOKS_DIR):
-        books = [item for item in os.listdir(BOOKS_DIR)
-                 if item.endswith("_data") and os.path.isdir(item)]
+    """
+    Get the single book folder. Returns None if not found or multiple exist.
+    Remembered once found, so `/` and the image fallback don't list the
+    directory on every request.
+    """
+    global CURRENT_BOOK_FOLDER
+    if CURRENT_BOOK_FOLDER is None and os.path.exists(BOOKS_DIR):
+        # scandir's entries know their type from the directory listing, so
+        # there's no separate stat per entry
+        with os.scandir(BOOKS_DIR) as entries:
+            books = [entry.name for entry in entries
+                     if entry.name.endswith("_data") and entry.is_dir()]
         if len(books) == 1:
-            return books[0]
-    return None
+            CURRENT_BOOK_FOLDER = books[0]
+    return CURRENT_BOOK_FOLDER
 
 @app.get("/", response_class=HTMLResponse)
 async def root(request: Request):
@@ -66,57 +124,85 @@ async def redirect_to_first_chapter(book_id: str):
     """Helper to just go to chapter 0."""
     return await read_chapter(book_id=book_id, chapter_index=0)
 
+def _get_chapter_conclusion(book_id: str, chapter: ChapterContent, title: str, authors: str) -> str:
+    """
+    Conclusion written from the whole chapter text, not just the stored sample.
+    Called in a worker thread, since the first access to `chapter.text` parses the HTML.
+    """
+    # No sample means the chapter is too short to be worth it (front matter etc.)
+    if not chapter.sample:
+        return ""
+    return get_ai_conclusion(book_id, chapter.text, title, authors)
+
+async def _fetch_ai_context(book_id: str, book: Book, current_chapter: ChapterContent):
+    """Book summary, prephrase, conclusion and paragraph teasers for one chapter."""
+    authors = ", ".join(book.metadata.authors)
+
+    # Paragraph teasers need nothing else, so start them right away
+    paragraph_task = asyncio.create_task(get_paragraph_summaries(
+        current_chapter.content,
+        book.metadata.title,
+        authors
+    ))
+
+    # The Claude helpers block, so they run in worker threads and the event
+    # loop stays free for other requests. The conclusion doesn't need the book
+    # summary, so it starts right away too
+    conclusion_task = asyncio.create_task(asyncio.to_thread(
+        _get_chapter_conclusion,
+        book_id,
+        current_chapter,
+        book.metadata.title,
+        authors
+    ))
+
+    # Prephrase (before chapter) uses the summary as context, so it waits only
+    # for the summary, not for the other tasks
+    summary = await asyncio.to_thread(
+        get_book_summary_cached,
+        book_id,
+        book.metadata.title,
+        authors,
+        book.intro_sample
+    )
+
+    ai_prephrase, ai_conclusion, paragraph_summaries = await asyncio.gather(
+        asyncio.to_thread(
+            get_chapter_prephrase,
+            book_id,
+            book.metadata.title,
+            authors,
+            current_chapter.sample,
+            summary
+        ),
+        conclusion_task,
+        paragraph_task,
+    )
+
+    return summary, ai_prephrase, ai_conclusion, paragraph_summaries
+
 @app.get("/read/{book_id}/{chapter_index}", response_class=HTMLResponse)
 async def read_chapter(request: Request, book_id: str, chapter_index: int):
     """The main reader interface."""
-    book = load_book_cached(book_id)
+    book = await load_book_cached(book_id)
     if not book:
         raise HTTPException(status_code=404, detail="Book not found")
 
     if chapter_index < 0 or chapter_index >= len(book.spine):
         raise HTTPException(status_code=404, detail="Chapter not found")
 
-    current_chapter = book.spine[chapter_index]
+    current_chapter = book.get_chapter(chapter_index)
 
     # Calculate Prev/Next links
     prev_idx = chapter_index - 1 if chapter_index > 0 else None
     next_idx = chapter_index + 1 if chapter_index < len(book.spine) - 1 else None
 
-    # Get book summary for context
-    content_sample = book.spine[0].content[:1000] if book.spine else ""
-    summary = get_book_summary(
-        book_id,
-        book.metadata.title,
-        ", ".join(book.metadata.authors),
-        content_sample
-    )
-
-    # Get AI Prephrase (before chapter)
-    # Use current chapter content, not book sample
-    chapter_sample = current_chapter.content[:1000] if current_chapter.content else ""
-    ai_prephrase = get_ai_prephrase(
-        book_id,
-        book.metadata.title,
-        ", ".join(book.metadata.authors),
-        chapter_sample,
-        summary
-    )
-
-    # Get AI Conclusion (after chapter)
-    ai_conclusion = get_ai_conclusion(
-        book_id,
-        current_chapter.content,
-        book.metadata.title,
-        ", ".join(book.metadata.authors),
-        summary
-    )
-
-    # Get paragraph summaries in parallel with book context
-    paragraph_summaries = await get_paragraph_summaries(
-        current_chapter.content,
-        book.metadata.title,
-        ", ".join(book.metadata.authors)
-    )
+    if AI_ENABLED:
+        summary, ai_prephrase, ai_conclusion, paragraph_summaries = await _fetch_ai_context(
+            book_id, book, current_chapter
+        )
+    else:
+        summary, ai_prephrase, ai_conclusion, paragraph_summaries = "", "", "", {}
 
     return templates.TemplateResponse("reader.html", {
         "request": request,
@@ -133,6 +219,18 @@ async def read_chapter(request: Request, book_id: str, chapter_index: int):
         "paragraph_summaries": paragraph_summaries
     })
 
+def _image_response(img_path: str) -> FileResponse:
+    """
+    Serves an image file, 404 if it doesn't exist.
+    The stat() result is handed to FileResponse so the file is only stat-ed once.
+    """
+    try:
+        stat_result = os.stat(img_path)
+    except OSError:
+        raise HTTPException(status_code=404, detail="Image not found")
+
+    return FileResponse(img_path, stat_result=stat_result)
+
 @app.get("/read/{book_id}/images/{image_name}")
 async def serve_image(book_id: str, image_name: str):
     """
@@ -145,10 +243,7 @@ async def serve_image(book_id: str, image_name: str):
 
     img_path = os.path.join(BOOKS_DIR, safe_book_id, "images", safe_image_name)
 
-    if not os.path.exists(img_path):
-        raise HTTPException(status_code=404, detail="Image not found")
-
-    return FileResponse(img_path)
+    return _image_response(img_path)
 
 @app.get("/{image_name:path}")
 async def serve_any_image(image_name: str):
@@ -157,7 +252,7 @@ async def serve_any_image(image_name: str):
     Only matches image extensions (.jpg, .png, .gif, .webp, .svg).
     """
     # Only serve image files
-    if not any(image_name.lower().endswith(ext) for ext in ('.jpg', '.jpeg', '.png', '.gif', '.webp', '.svg')):
+    if os.path.splitext(image_name)[1].lower() not in _IMAGE_EXTENSIONS:
         raise HTTPException(status_code=404, detail="Not an image")
 
     # Get current book
@@ -170,10 +265,7 @@ async def serve_any_image(image_name: str):
 
     img_path = os.path.join(BOOKS_DIR, book_folder, "images", safe_image_name)
 
-    if not os.path.exists(img_path):
-        raise HTTPException(status_code=404, detail="Image not found")
-
-    return FileResponse(img_path)
+    return _image_response(img_path)
 
 if __name__ == "__main__":
     import uvicorn